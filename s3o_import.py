@@ -26,32 +26,71 @@ bl_info = {
     "category": "Import-Export",
 }
 
-import bpy, bmesh
-from mathutils import Vector
+import bpy
+import numpy as np
 # ImportHelper is a helper class, defines filename and invoke() function which calls the file selector
 from bpy_extras.io_utils import ImportHelper
 
 import os
 import sys
 import math
-import struct
-from struct import calcsize, unpack
-
-
-try:
-    os.SEEK_SET
-except AttributeError:
-    os.SEEK_SET, os.SEEK_CUR, os.SEEK_END = range(3)
-
-
-def read_string(fhandle, offset):
-    fhandle.seek(offset, os.SEEK_SET)
-    string = ''
-    c = fhandle.read(1)
-    while(c != b'' and c != b'\x00'):
-        string += c.decode('ascii')
-        c = fhandle.read(1)
-    return string
+import ctypes
+import functools
+from collections import deque
+
+
+# Binary layouts of the S3O records
+class s3o_header_layout(ctypes.LittleEndianStructure):  # "<12sI5f4I"
+    _pack_ = 1
+    _fields_ = [("magic", ctypes.c_char * 12),  # "Spring unit\0"
+                ("version", ctypes.c_uint32),  # uint = 0
+                ("radius", ctypes.c_float),  # radius of collision sphere
+                ("height", ctypes.c_float),  # height of whole object
+                ("midx", ctypes.c_float),  # offset from origin
+                ("midy", ctypes.c_float),
+                ("midz", ctypes.c_float),
+                ("rootPieceOffset", ctypes.c_uint32),  # offset of root piece
+                # offset of collision data, 0 = no data
+                ("collisionDataOffset", ctypes.c_uint32),
+                # offsets to filenames of 1st and 2nd textures
+                ("texture1Offset", ctypes.c_uint32),
+                ("texture2Offset", ctypes.c_uint32)]
+
+
+class s3o_piece_layout(ctypes.LittleEndianStructure):  # "<10I3f"
+    _pack_ = 1
+    _fields_ = [("nameOffset", ctypes.c_uint32),
+                ("numChildren", ctypes.c_uint32),
+                ("childrenOffset", ctypes.c_uint32),
+                ("numVerts", ctypes.c_uint32),
+                ("vertsOffset", ctypes.c_uint32),
+                ("vertType", ctypes.c_uint32),
+                # 0 = tri, 1 = tristrips, 2 = quads
+                ("primitiveType", ctypes.c_uint32),
+                # number of indexes in vert table
+                ("vertTableSize", ctypes.c_uint32),
+                ("vertTableOffset", ctypes.c_uint32),
+                ("collisionDataOffset", ctypes.c_uint32),
+                ("xoffset", ctypes.c_float),
+                ("yoffset", ctypes.c_float),
+                ("zoffset", ctypes.c_float)]
+
+
+def read_string(buf, offset):
+    # Null offsets are used to flag missing strings
+    if offset == 0:
+        return ''
+    end = buf.find(b'\x00', offset)
+    if end == -1:
+        end = len(buf)
+    return buf[offset:end].decode('ascii')
+
+
+def read_array(buf, dtype, count, offset):
+    # Empty tables may come with garbage offsets, which should not be touched
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
 
 
 def folder_root(folder, name):
@@ -87,6 +126,15 @@ def folder_root(folder, name):
     return folder[:index]
 
 
+@functools.lru_cache(maxsize=None)
+def listdir_ci(folder):
+    """Cached case insensitive index of the folder contents, mapping the lower
+    case names onto the actual ones. The cache is cleared on each import
+    """
+    with os.scandir(folder) as entries:
+        return {e.name.lower(): e.name for e in entries}
+
+
 def find_in_folder(folder, name):
     """Case insensitive file/folder search tool
     
@@ -104,61 +152,30 @@ def find_in_folder(folder, name):
     filename : string
         The file name (case sensitive), None if the file cannot be found.
     """
-    for filename in os.listdir(folder):
-        if filename.lower() == name.lower():
-            return filename
-    return None
+    return listdir_ci(folder).get(name.lower())
 
 
 class s3o_header(object):
-    binary_format = "<12sI5f4I"
-
-    magic = 'Spring unit'  # char [12] "Spring unit\0"
-    version = 0    # uint = 0
-    radius = 0.0 # float: radius of collision sphere
-    height = 0.0 # float: height of whole object
-    midx = 0.0 # float offset from origin
-    midy = 0.0 #
-    midz = 0.0 #
-    rootPieceOffset = 0 # offset of root piece
-    collisionDataOffset = 0 # offset of collision data, 0 = no data
-    texture1Offset = 0 # offset to filename of 1st texture
-    texture2Offset = 0 # offset to filename of 2nd texture
-
-    def load(self, fhandle):
-        tmp_data = fhandle.read(struct.calcsize(self.binary_format))
-        data = struct.unpack(self.binary_format, tmp_data)
-        self.magic = data[0].decode('ascii').replace('\x00', '').strip()
+    def __init__(self):
+        self.texture1 = ''
+        self.texture2 = ''
+
+    def load(self, buf):
+        self.layout = s3o_header_layout.from_buffer_copy(buf, 0)
+        self.magic = self.layout.magic.decode('ascii').strip()
         if(self.magic != 'Spring unit'):
             raise IOError("Not a Spring unit file: '" + self.magic + "'")
             return
-        self.version = data[1]
-        if(self.version != 0):
-            raise ValueError('Wrong file version: ' + self.version)
+        if(self.layout.version != 0):
+            raise ValueError('Wrong file version: ' + self.layout.version)
             return
-        self.radius = data[2]
-        self.height = data[3]
-        self.midx = -data[4]
-        self.midy = data[5]
-        self.midz = data[6]
-        self.rootPieceOffset = data[7]
-        self.collisionDataOffset = data[8]
-
-        self.texture1Offset = data[9]
-        if(self.texture1Offset == 0):
-            self.texture1 = ''
-        else:
-            self.texture1 = read_string(fhandle, self.texture1Offset)
 
-        self.texture2Offset = data[10]
-        if(self.texture2Offset == 0):
-            self.texture2 = ''
-        else:
-            self.texture2 = read_string(fhandle, self.texture2Offset)
+        self.texture1 = read_string(buf, self.layout.texture1Offset)
+        self.texture2 = read_string(buf, self.layout.texture2Offset)
         return
 
 
-def remove_doubles(verts):
+def remove_doubles(positions, normals, tol=1E-6):
     """I would say (J.L. Cercos-Pita aka SanguinarioJoe) this is an upspring
     fault. Anyway, it is happening that the imported models have duplicated
     vertices, i.e. vertices that are in the same exact position, and have the
@@ -168,241 +185,178 @@ def remove_doubles(verts):
     is correcting the normals after a wide variety of operations, like entering
     in edit mode, or exporting the mesh.
     Thus, this method is checking and merging the vertexes with the same
-    position AND NORMAL. It is also returning a dictionary to translate the
-    original vertice indexes onto the new ones
+    position AND NORMAL. It is returning the indexes of the vertices to be kept,
+    and an array to translate the original vertice indexes onto the new ones
     """
-    def find_vert(verts, vert):
-        def equal(a, b, tol=1E-6):
-            return abs(a - b) < tol
-        def equal_verts(a, b):
-            return equal(a.xpos, b.xpos) and \
-                   equal(a.ypos, b.ypos) and \
-                   equal(a.zpos, b.zpos) and \
-                   equal(a.xnormal, b.xnormal) and \
-                   equal(a.ynormal, b.ynormal) and \
-                   equal(a.znormal, b.znormal)
-        for i, v in enumerate(verts):
-            if equal_verts(v, vert):
-                return i
-        return None
-
-    new_verts = []
-    indexes = list(range(len(verts)))
-    for i,v in enumerate(verts):
-        j = find_vert(new_verts, v)
-        if j is None:
-            indexes[i] = len(new_verts)
-            new_verts.append(v)
+    verts = np.hstack((positions, normals))
+    new_verts = np.empty_like(verts)
+    unique_ids = []
+    indexes = np.empty(len(verts), dtype=np.intp)
+    for i, v in enumerate(verts):
+        n = len(unique_ids)
+        j = np.flatnonzero(np.all(np.abs(new_verts[:n] - v) < tol, axis=1))
+        if len(j):
+            indexes[i] = j[0]
         else:
-            indexes[i] = j
+            indexes[i] = n
+            new_verts[n] = v
+            unique_ids.append(i)
 
-    return new_verts, indexes
+    return np.array(unique_ids, dtype=np.intp), indexes
 
 
 class s3o_piece(object):
-    binary_format = "<10I3f"
-
     name = ''
-    verts = []
-    faces = []
-    parent = '' 
-    children = []
-
-    nameOffset = 0 # uint
-    numChildren = 0 # uint
-    childrenOffset = 0 # uint
-    numVerts = 0 # uint
-    vertsOffset = 0 # uint
-    vertType = 0 # uint
-    primitiveType = 0 # 0 = tri, 1 = tristrips, 2 = quads
-    vertTableSize = 0 # number of indexes in vert table
-    vertTableOffset = 0
-    collisionDataOffset = 0
-    xoffset = 0.0
-    yoffset = 0.0
-    zoffset = 0.0
-
-    def load(self, fhandle, offset, material, collection=None):
-        fhandle.seek(offset, os.SEEK_SET)
-        tmp_data = fhandle.read(struct.calcsize(self.binary_format))
-        data = struct.unpack(self.binary_format, tmp_data)
-
-        self.nameOffset = data[0]
-        self.numChildren = data[1]
-        self.childrenOffset = data[2]
-        self.numVerts = data[3]
-        self.vertsOffset = data[4]
-        self.vertType = data[5]
-        self.primitiveType = data[6]
-        self.vertTableSize = data[7]
-        self.vertTableOffset = data[8]
-        self.collisionDataOffset = data[9]
-        self.xoffset = data[10]
-        self.yoffset = data[11]
-        self.zoffset = data[12]
+
+    def __init__(self):
+        self.faces = []
+        self.parent = None
+        self.children = []
+
+    def load(self, buf, offset):
+        self.offset = offset
+        self.layout = s3o_piece_layout.from_buffer_copy(buf, offset)
 
         # load self
         # get name
-        fhandle.seek(self.nameOffset, os.SEEK_SET)
-        self.name = read_string(fhandle, self.nameOffset)
+        self.name = read_string(buf, self.layout.nameOffset)
 
         # load verts
-        self.verts = []
-        for i in range(0, self.numVerts):
-            vert = s3o_vert()
-            vert.load(fhandle, self.vertsOffset + (i * struct.calcsize(vert.binary_format)))
-            self.verts.append(vert)
+        data = read_array(buf, '<f4', self.layout.numVerts * 8,
+                          self.layout.vertsOffset).reshape(-1, 8)
+        self.positions = data[:, 0:3]
+        self.normals = data[:, 3:6]
+        self.uvs = data[:, 6:8]
         # We want to keep the original vertices because of the UVs information
-        self.unique_verts, self.vertids = remove_doubles(self.verts)
+        self.unique_verts, self.vertids = remove_doubles(self.positions,
+                                                         self.normals)
 
         # load primitives
-        fhandle.seek(self.vertTableOffset, os.SEEK_SET)
-        self.faces = []
-        if(self.primitiveType == 0): # triangles
-            i = 0
-            while(i < self.vertTableSize):
-                tmp = fhandle.read(4 * 3)
-                data = struct.unpack("<3I", tmp)
-                face = [ int(data[0]), int(data[1]), int(data[2]) ]
-                self.faces.append(face)
-                i += 3
-        elif(self.primitiveType == 1): # tristrips
+        if(self.layout.primitiveType == 0): # triangles
+            nsides = 3
+        elif(self.layout.primitiveType == 1): # tristrips
             raise TypeError('Tristrips are unsupported so far')
-        elif(self.primitiveType == 2): # quads
-            i = 0
-            while(i < self.vertTableSize):
-                tmp = fhandle.read(4 * 4)
-                data = struct.unpack("<4I", tmp)
-                face = [ int(data[0]), int(data[1]), int(data[2]), int(data[3]) ]
-                self.faces.append(face)
-                i += 4
+        elif(self.layout.primitiveType == 2): # quads
+            nsides = 4
         else:
-            raise TypeError('Unknown primitive type: ' + self.primitiveType)
-
-        try:
-            for obj in bpy.context.selected_objects:
-                obj.select_set(False)
-        except AttributeError:
-            # Blender < 2.80
-            bpy.ops.object.select_all(action='DESELECT')
+            raise TypeError('Unknown primitive type: ' +
+                            self.layout.primitiveType)
+        self.faces = read_array(buf, '<u4', self.layout.vertTableSize,
+                                self.layout.vertTableOffset).reshape(-1, nsides)
+
+        # childrenOffset contains DWORDS containing offsets to child pieces
+        self.childOffsets = read_array(buf, '<u4', self.layout.numChildren,
+                                       self.layout.childrenOffset)
+        return
 
+    def build(self, material, collection=None):
         # if it has no verts or faces create an EMPTY instead
-        if(self.numVerts == 0):
-            bpy.ops.object.empty_add(type="PLAIN_AXES", location=(0, 0, 0))
-            self.ob = bpy.context.active_object
-            self.ob.name = self.name
+        if(self.layout.numVerts == 0):
+            self.ob = bpy.data.objects.new(self.name, None)
             try:
-                if collection is not None and \
-                   collection != bpy.context.scene.collection:
-                    for c in self.ob.users_collection:
-                        c.objects.unlink(self.ob)
-                    collection.objects.link(self.ob)
-                    try:
-                        bpy.context.scene.collection.objects.unlink(self.ob)
-                    except RuntimeError:
-                        pass
+                self.ob.empty_display_type = 'PLAIN_AXES'
             except AttributeError:
-                pass
+                # Blender < 2.80
+                self.ob.empty_draw_type = 'PLAIN_AXES'
         else:
-            bm = bmesh.new()
-            for v in self.unique_verts:
-                bm.verts.new((v.xpos, v.ypos, v.zpos))
-                bm.verts.ensure_lookup_table()
-                bm.verts[-1].normal = Vector((v.xnormal, v.ynormal, v.znormal))
-            for f in self.faces:
-                try:
-                    bm.faces.new([bm.verts[self.vertids[i]] for i in f])
-                except ValueError:
-                    # Due to the removed vertices, degenerated faces would
-                    # become strictly invalid, using several times the same
-                    # vertex. We just simply ignore them
-                    pass
-                bm.faces.ensure_lookup_table()
-                uv_layer = bm.loops.layers.uv.verify()
-                for i, loop in enumerate(bm.faces[-1].loops):
-                    uv = loop[uv_layer].uv
-                    uv[0] = self.verts[f[i]].texu
-                    uv[1] = self.verts[f[i]].texv
-
+            # Due to the removed vertices, degenerated faces would become
+            # strictly invalid, using several times the same vertex. Other
+            # faces may collapse onto an already existing one. We just simply
+            # ignore them, keeping the first occurrence
+            faces = np.sort(self.vertids[self.faces], axis=1)
+            valid = np.all(faces[:, 1:] != faces[:, :-1], axis=1)
+            first = np.zeros(len(faces), dtype=bool)
+            first[np.unique(faces, axis=0, return_index=True)[1]] = True
+            loops = self.faces[valid & first]
             self.mesh = bpy.data.meshes.new(self.name)
-            bm.to_mesh(self.mesh)
-            self.ob = bpy.data.objects.new(self.name, self.mesh)
+            self.mesh.from_pydata(
+                self.positions[self.unique_verts].tolist(),
+                [],
+                self.vertids[loops].tolist())
             try:
-                collection = collection or bpy.context.scene.collection
-                collection.objects.link(self.ob)
+                self.mesh.uv_layers.new(name="UVMap")
             except AttributeError:
                 # Blender < 2.80
-                bpy.context.scene.objects.link(self.ob)
-            try:
-                bpy.context.scene.update()
-            except AttributeError:
-                # Blender > 2.80
-                # The scene doesn't seem to need specifically updating in the latest 2.80
-                pass
-            try:
-                self.ob.select_set(True)
-                bpy.context.view_layer.objects.active = self.ob
-            except AttributeError:
-                # Blender < 2.80
-                bpy.context.scene.objects.active = self.ob
-            bpy.ops.object.shade_smooth()
-            if bpy.context.object is not None: # NoneType objects can get here recently.
-                if hasattr(bpy.context.object.data, "use_auto_smooth"):
-                    bpy.context.object.data.use_auto_smooth = False
-                    # bpy.context.object.data.auto_smooth_angle = 0.785398 # 45 degrees, better than 30 for low poly stuff.
+                self.mesh.uv_textures.new(name="UVMap")
+            uvs = self.uvs[loops.ravel()]
+            self.mesh.uv_layers.active.data.foreach_set("uv", uvs.ravel())
+            self.mesh.update()
+            # Mesh.update() recomputes the vertex normals, so the ones from the
+            # file are set afterwards
+            self.mesh.vertices.foreach_set(
+                "normal", self.normals[self.unique_verts].ravel())
+            self.ob = bpy.data.objects.new(self.name, self.mesh)
+            self.mesh.polygons.foreach_set(
+                "use_smooth", np.ones(len(self.mesh.polygons), dtype=bool))
+            if hasattr(self.mesh, "use_auto_smooth"):
+                self.mesh.use_auto_smooth = False
+                # self.mesh.auto_smooth_angle = 0.785398 # 45 degrees, better than 30 for low poly stuff.
 
-            matidx = len(self.ob.data.materials)
-            self.ob.data.materials.append(material) 
+            # The mesh is brand new, so the material goes to the first slot,
+            # which is already the default polygons material_index
+            self.ob.data.materials.append(material)
 
-            for face in self.mesh.polygons:
-                face.material_index = matidx
+        try:
+            collection = collection or bpy.context.scene.collection
+            collection.objects.link(self.ob)
+        except AttributeError:
+            # Blender < 2.80
+            bpy.context.scene.objects.link(self.ob)
 
         if(self.parent):
             self.ob.parent = self.parent.ob
-        self.ob.location = [self.xoffset, self.yoffset, self.zoffset]
+        self.ob.location = [self.layout.xoffset, self.layout.yoffset,
+                            self.layout.zoffset]
         self.ob.rotation_mode = 'ZXY'
-
-        # load children
-        if(self.numChildren > 0):
-            # childrenOffset contains DWORDS containing offsets to child pieces
-            fhandle.seek(self.childrenOffset, os.SEEK_SET)
-            for i in range(0, self.numChildren):
-                tmp = fhandle.read(4)
-                offset = fhandle.tell()
-                data = struct.unpack("<I", tmp)
-                childOffset = data[0]
-                child = s3o_piece()
-                child.parent = self
-                child.load(fhandle, childOffset, material, collection)
-                self.children.append(child)
-                fhandle.seek(offset, os.SEEK_SET)
         return
 
 
-class s3o_vert(object):
-    binary_format = "<8f"
-    xpos = 0.0
-    ypos = 0.0
-    zpos = 0.0
-    xnormal = 0.0
-    ynormal = 0.0
-    znormal = 0.0
-    texu = 0.0
-    texv = 0.0
-
-    def load(self, fhandle, offset):
-        fhandle.seek(offset, os.SEEK_SET)
-        tmp_data = fhandle.read(struct.calcsize(self.binary_format))
-        data = struct.unpack(self.binary_format, tmp_data)
-
-        self.xpos = data[0]
-        self.ypos = data[1]
-        self.zpos = data[2]
-        self.xnormal = data[3]
-        self.ynormal = data[4]
-        self.znormal = data[5]
-        self.texu = data[6]
-        self.texv = data[7]
+def collect_pieces(buf, offset):
+    """Load the whole pieces tree, without creating any Blender object.
+
+    The tree is walked iteratively, in breadth-first order, so the parent of
+    each piece is always found before the piece itself.
+
+    Parameters
+    ==========
+
+    buf : bytes
+        The S3O file contents
+    offset : int
+        Offset of the root piece
+
+    Returns
+    =======
+
+    pieces : list
+        The loaded pieces, starting by the root one
+
+    Raises
+    ======
+
+    IOError
+        If a piece lists itself, or one of its ancestors, as a child. Pieces
+        shared by several parents are fine, and loaded once per parent
+    """
+    pieces = []
+    queue = deque([(offset, None)])
+    while queue:
+        offset, parent = queue.popleft()
+        piece = s3o_piece()
+        piece.load(buf, offset)
+        if parent is not None:
+            piece.parent = parent
+            parent.children.append(piece)
+        pieces.append(piece)
+        for childOffset in piece.childOffsets:
+            ancestor = piece
+            while ancestor:
+                if ancestor.offset == childOffset:
+                    raise IOError("Cyclic pieces tree at offset " +
+                                  str(childOffset))
+                ancestor = ancestor.parent
+            queue.append((childOffset, piece))
+    return pieces
 
 
 def new_material_legacy(tex1, tex2, texsdir, name="Material"):
@@ -516,6 +470,7 @@ def new_material(tex1, tex2, texsdir, name="Material"):
 
 
 def load_s3o_file(s3o_filename, context, BATCH_LOAD=False):
+    listdir_ci.cache_clear()
     basename = os.path.basename(s3o_filename)
     objdir = os.path.dirname(s3o_filename)
     rootdir = folder_root(objdir, "objects3d")
@@ -524,10 +479,11 @@ def load_s3o_file(s3o_filename, context, BATCH_LOAD=False):
     else:
         texsdir = os.path.join(rootdir, find_in_folder(rootdir, 'unittextures'))
 
-    fhandle = open(s3o_filename, "rb")
+    with open(s3o_filename, "rb") as fhandle:
+        buf = fhandle.read()
 
     header = s3o_header()
-    header.load(fhandle)
+    header.load(buf)
 
     mat = new_material(header.texture1, header.texture2, texsdir, name=basename)
 
@@ -538,20 +494,25 @@ def load_s3o_file(s3o_filename, context, BATCH_LOAD=False):
         # Blender < 2.80
         collection = None
 
-    rootPiece = s3o_piece()
-    rootPiece.load(fhandle, header.rootPieceOffset, mat, collection)
+    for piece in collect_pieces(buf, header.layout.rootPieceOffset):
+        piece.build(mat, collection)
+    try:
+        bpy.context.scene.update()
+    except AttributeError:
+        # Blender > 2.80
+        # The scene doesn't seem to need specifically updating in the latest 2.80
+        pass
 
     # create collision sphere
+    center = (-header.layout.midx, header.layout.midz, header.layout.midy)
     bpy.ops.object.empty_add(type="SPHERE",
-                             location=(header.midx, header.midz, header.midy),
-                             radius=header.radius)
+                             location=center,
+                             radius=header.layout.radius)
     bpy.context.active_object.name = basename + '.SpringRadius'
     bpy.ops.object.empty_add(type="ARROWS",
-                             location=(header.midx, header.midz, header.midy),
+                             location=center,
                              radius=10.0)
     bpy.context.active_object.name = basename + '.SpringHeight'
-
-    fhandle.close()
     return
 
 